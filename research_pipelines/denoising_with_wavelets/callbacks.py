@@ -38,6 +38,19 @@ class AbstractCallback(object):
         raise RuntimeError("Don\'t implement early stopping callback method")
 
 
+class VisStepMixin(object):
+    """Batches counter of visualization callbacks, images are drawn every self.step batches"""
+    def should_emit(self) -> bool:
+        """Check that next per_batch call will draw images"""
+        return self.n % self.step == 0
+
+    def skip_batch(self):
+        """Count batch without visualization"""
+        self.n += 1
+        if self.n >= 1000000000:
+            self.n = 0
+
+
 class SaveBestModelAndOptimizer(AbstractCallback):
     def __init__(self,
                  path: str,
@@ -225,7 +238,7 @@ class VisPlot(AbstractCallback):
         pass
 
 
-class VisImageForWavelets(AbstractCallback):
+class VisImageForWavelets(VisStepMixin, AbstractCallback):
     def __init__(self, title, server='http://localhost', port=8080,
                  vis_step=1, scale=10):
         self.viz = Visdom(server=server, port=port)
@@ -273,7 +286,7 @@ class VisImageForWavelets(AbstractCallback):
         return preprocess_image(rgb_image, self.img_mean, self.img_std)
 
     def per_batch(self, args, label=1):
-        if self.n % self.step == 0:
+        if self.should_emit():
             i = random.randint(0, args['lr_img'].size(0) - 1)
 
             for win in self.windows.keys():
@@ -307,9 +320,7 @@ class VisImageForWavelets(AbstractCallback):
                         opts=dict(title=self.title)
                     )
 
-        self.n += 1
-        if self.n >= 1000000000:
-            self.n = 0
+        self.skip_batch()
 
     def per_epoch(self, args):
         pass
@@ -329,7 +340,7 @@ class VisImage(VisImageForWavelets):
         # self.change_color_function = lambda x: x
 
     def per_batch(self, args, label=1, i: Optional[int] = None) -> Optional[int]:
-        if self.n % self.step == 0:
+        if self.should_emit():
             if i is None:
                 i = random.randint(0, args['gt_image'].size(0) - 1)
 
@@ -406,9 +417,7 @@ class VisImage(VisImageForWavelets):
                         opts=dict(title=self.title)
                     )
 
-        self.n += 1
-        if self.n >= 1000000000:
-            self.n = 0
+        self.skip_batch()
 
         return i
 
@@ -422,7 +431,7 @@ class VisImage(VisImageForWavelets):
         self.windows[label] = None
 
 
-class VisAttentionMaps(AbstractCallback):
+class VisAttentionMaps(VisStepMixin, AbstractCallback):
     def __init__(self, title, server='http://localhost', port=8080,
                  vis_step=1, scale=10, maps_count: int = 6):
         self.viz = Visdom(server=server, port=port)
@@ -437,7 +446,7 @@ class VisAttentionMaps(AbstractCallback):
         random.seed()
 
     def per_batch(self, args, label=1, i: Optional[int] = None) -> Optional[int]:
-        if self.n % self.step == 0:
+        if self.should_emit():
             if i is None:
                 i = random.randint(0, args['sa_list'][0].size(0) - 1)
 
@@ -464,9 +473,7 @@ class VisAttentionMaps(AbstractCallback):
                         opts=dict(title=self.title)
                     )
 
-        self.n += 1
-        if self.n >= 1000000000:
-            self.n = 0
+        self.skip_batch()
 
         return i
 
@@ -7,11 +7,90 @@ import torchvision
 from torch.utils.data import Dataset
 import os
 from tqdm import tqdm
+from PIL import Image
 
-from utils.image_utils import random_crop_with_transforms, pil_load_image as load_image
+from utils.image_utils import random_crop_with_transforms, random_crop_to_ycrcb, FAST_TRANSFORMS_AVAILABLE, pil_load_image as load_image
 from utils.tensor_utils import preprocess_image
 
 
+def list_collate(batch: List[tuple]) -> tuple:
+    """Collate samples into per-field lists, so images of different sizes could be batched"""
+    return tuple(list(field) for field in zip(*batch))
+
+
+class MemmapImagesCache(object):
+    """
+    Read-only storage of RGB images of different sizes packed into one memory mapped .npy file.
+    Pages of the file are shared between dataloader workers through OS page cache.
+    """
+    def __init__(self, images_paths: List[str], cache_file: str):
+        assert len(images_paths) > 0, 'No images to pack into {}'.format(cache_file)
+        self.cache_file = cache_file
+        self.index_file = os.path.splitext(cache_file)[0] + '_index.npz'
+
+        if not self._is_cache_valid(images_paths):
+            self._pack_images(images_paths)
+
+        # Rows of (offset, height, width)
+        with np.load(self.index_file) as index_data:
+            self.index = index_data['index']
+        # Opened lazily to not pickle memory map into spawned workers
+        self.data = None
+
+    @staticmethod
+    def _files_stats(images_paths: List[str]) -> np.ndarray:
+        # Rows of (size in bytes, modification time in ns) to detect regenerated images
+        stats = [os.stat(img_path) for img_path in images_paths]
+        return np.array([(st.st_size, st.st_mtime_ns) for st in stats], dtype=np.int64).reshape(-1, 2)
+
+    def _is_cache_valid(self, images_paths: List[str]) -> bool:
+        if not os.path.isfile(self.cache_file) or not os.path.isfile(self.index_file):
+            return False
+        with np.load(self.index_file) as index_data:
+            if 'stats' not in index_data or index_data['paths'].tolist() != images_paths:
+                return False
+            packed_stats = index_data['stats']
+        if not np.array_equal(packed_stats, self._files_stats(images_paths)):
+            print('Images were changed after packing {}, rebuilding it'.format(self.cache_file))
+            return False
+        return True
+
+    def _pack_images(self, images_paths: List[str]):
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), exist_ok=True)
+
+        index = np.zeros((len(images_paths), 3), dtype=np.int64)
+        offset = 0
+        for i, img_path in enumerate(images_paths):
+            with Image.open(img_path) as img:
+                w, h = img.size
+            index[i] = (offset, h, w)
+            offset += h * w * 3
+
+        data = np.lib.format.open_memmap(self.cache_file, mode='w+', dtype=np.uint8, shape=(offset,))
+        print('Packing images into {}:'.format(self.cache_file))
+        for i, img_path in enumerate(tqdm(images_paths)):
+            img_offset, h, w = index[i]
+            data[img_offset:img_offset + h * w * 3] = load_image(img_path).reshape(-1)
+        data.flush()
+        del data
+
+        np.savez(
+            self.index_file,
+            index=index,
+            paths=np.array(images_paths),
+            stats=self._files_stats(images_paths)
+        )
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        if self.data is None:
+            self.data = np.load(self.cache_file, mmap_mode='r')
+        offset, h, w = self.index[idx]
+        return self.data[offset:offset + h * w * 3].reshape(h, w, 3)
+
+
 class PairedDenoiseDataset(Dataset):
     def __init__(self,
                  noisy_images_path,
@@ -20,7 +99,11 @@ class PairedDenoiseDataset(Dataset):
                  window_size: int = 224,
                  optional_dataset_size: Optional[int] = None,
                  preload: bool = False,
-                 return_names: bool = False):
+                 return_names: bool = False,
+                 mmap_cache_dir: Optional[str] = None,
+                 fast_transforms: bool = False):
+        assert not fast_transforms or FAST_TRANSFORMS_AVAILABLE, 'Fast transforms require numba package'
+
         self.noisy_images = {
             os.path.splitext(img_name)[0]: os.path.join(noisy_images_path, img_name)
             for img_name in os.listdir(noisy_images_path)
@@ -37,10 +120,23 @@ class PairedDenoiseDataset(Dataset):
         self.window_size = window_size
         self.need_crop = need_crop
         self.return_names = return_names
+        self.fast_transforms = fast_transforms
 
         self.names = [img_name for img_name in os.listdir(clear_images_path)]
 
-        if preload:
+        self.noisy_cache = None
+        self.clear_cache = None
+
+        if mmap_cache_dir is not None:
+            self.noisy_cache = MemmapImagesCache(
+                [self.noisy_images[key] for key in self.images_keys],
+                os.path.join(mmap_cache_dir, 'noisy.npy')
+            )
+            self.clear_cache = MemmapImagesCache(
+                [self.clear_images[key] for key in self.images_keys],
+                os.path.join(mmap_cache_dir, 'clear.npy')
+            )
+        elif preload:
             print('Loading images into RAM:')
             for key in tqdm(self.images_keys):
                 self.noisy_images[key] = load_image(self.noisy_images[key])
@@ -52,14 +148,30 @@ class PairedDenoiseDataset(Dataset):
     def __getitem__(self, _idx: int) -> Union[Tuple[torch.Tensor, torch.Tensor], Tuple[torch.Tensor, torch.Tensor, str]]:
         idx = _idx % len(self.images_keys)
 
-        noisy_image = self.noisy_images[self.images_keys[idx]]
-        clear_image = self.clear_images[self.images_keys[idx]]
+        if self.noisy_cache is not None:
+            noisy_image = self.noisy_cache[idx]
+            clear_image = self.clear_cache[idx]
+        else:
+            noisy_image = self.noisy_images[self.images_keys[idx]]
+            clear_image = self.clear_images[self.images_keys[idx]]
 
         if isinstance(noisy_image, str):
             noisy_image = load_image(noisy_image)
         if isinstance(clear_image, str):
             clear_image = load_image(clear_image)
 
+        if self.need_crop and self.fast_transforms:
+            noisy_crop, clear_crop = random_crop_to_ycrcb(
+                noisy_image, clear_image,
+                window_size=self.window_size
+            )
+            noisy_tensor, clear_tensor = torch.from_numpy(noisy_crop), torch.from_numpy(clear_crop)
+
+            if self.return_names:
+                return noisy_tensor, clear_tensor, self.names[idx]
+
+            return noisy_tensor, clear_tensor
+
         if self.need_crop:
             noisy_image, clear_image = random_crop_with_transforms(
                 noisy_image, clear_image,
@@ -82,13 +194,19 @@ class SyntheticNoiseDataset(Dataset):
                  clear_images_path, 
                  window_size: int = 224,
                  optional_dataset_size: Optional[int] = None,
-                 preload: bool = False):
+                 preload: bool = False,
+                 mmap_cache_dir: Optional[str] = None):
         self.clear_images = [
             os.path.join(clear_images_path, img_name)
             for img_name in os.listdir(clear_images_path)
         ]
 
-        if preload:
+        if mmap_cache_dir is not None:
+            self.clear_images = MemmapImagesCache(
+                self.clear_images,
+                os.path.join(mmap_cache_dir, 'clear.npy')
+            )
+        elif preload:
             print('Loading images into RAM:')
             self.clear_images = [
                 load_image(imgp)
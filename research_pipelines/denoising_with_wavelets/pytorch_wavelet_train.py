@@ -1,9 +1,8 @@
 from typing import Tuple, Optional
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentParser, Namespace
 
-import cv2
-import numpy as np
 import tqdm
 import torch
 from torch.utils import data
@@ -16,12 +15,13 @@ from torchmetrics.image import PeakSignalNoiseRatio as TorchPSNR
 from pytorch_msssim import SSIM, MS_SSIM
 from piq import DISTS
 from pytorch_optimizer import AdaSmooth, Ranger21
-from utils.haar_utils import HaarForward, HaarInverse
+from utils.haar_utils import HaarForward, HaarInverse, haar_pyramid
 
-from dataloader import PairedDenoiseDataset, SyntheticNoiseDataset
+from dataloader import PairedDenoiseDataset, SyntheticNoiseDataset, list_collate
 from callbacks import VisImage, VisAttentionMaps, VisPlot
 from WTSNet.wts_timm import WTSNetTimm
-from utils.window_inference import denoise_inference
+from utils.window_inference import denoise_inference_batch
+from utils.image_utils import FAST_TRANSFORMS_AVAILABLE
 from utils.hist_loss import HistLoss
 from utils.freq_loss import HFENLoss
 from utils.adversarial_loss import Adversarial
@@ -35,30 +35,58 @@ class SSIMLoss(SSIM):
 class MIXLoss(MS_SSIM):
     def forward(self, x, y):
         return (1. - super().forward(x, y)) * (1-0.84) + torch.nn.functional.l1_loss(x, y) * 0.84
-    
+
+
+def state_to_cpu(state):
+    """Copy all tensors of (nested) state dict to CPU, so it could be saved while training continues"""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {k: state_to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(v) for v in state)
+    return state
+
+
+def build_haar_weight(in_channels: int = 3) -> torch.Tensor:
+    """
+    Build depthwise Haar filters of shape [in_channels * 4, 1, 2, 2]
+    with LL, LH, HL, HH filters per input channel
+    """
+    haar_kernel = torch.tensor(
+        [
+            [[1, 1], [1, 1]],
+            [[1, 1], [-1, -1]],
+            [[1, -1], [1, -1]],
+            [[1, -1], [-1, 1]]
+        ],
+        dtype=torch.float32
+    ).unsqueeze(1)
+    return haar_kernel.repeat(in_channels, 1, 1, 1)
+
 
 class DWTHaar(torch.nn.Module):
-    def __init__(self):
+    def __init__(self, in_channels: int = 3):
         super().__init__()
-        self.dwt = HaarForward()
+        self.in_channels = in_channels
+        self.register_buffer('haar_fwd', build_haar_weight(in_channels) * HaarForward.alpha, persistent=False)
 
     def forward(self, x):
-        out = self.dwt(x)
-        step = out.size(1) // 4
-        ll = out[:, :step]
-        lh = out[:, step:step*2]
-        hl = out[:, step*2:step*3]
-        hh = out[:, step*3:]
+        out = torch.nn.functional.conv2d(x, self.haar_fwd, stride=2, groups=self.in_channels)
+        out = out.view(out.size(0), self.in_channels, 4, out.size(2), out.size(3))
+        ll, lh, hl, hh = out.unbind(dim=2)
         return [ll, lh, hl, hh]
     
 
 class IWTHaar(torch.nn.Module):
-    def __init__(self):
+    def __init__(self, in_channels: int = 3):
         super().__init__()
-        self.iwt = HaarInverse()
+        self.in_channels = in_channels
+        self.register_buffer('haar_inv', build_haar_weight(in_channels) * HaarInverse.alpha, persistent=False)
 
     def forward(self, ll, lh, hl, hh):
-        return self.iwt(torch.cat((ll, lh, hl, hh), dim=1))
+        stacked = torch.stack((ll, lh, hl, hh), dim=2).flatten(1, 2)
+        return torch.nn.functional.conv_transpose2d(stacked, self.haar_inv, stride=2, groups=self.in_channels)
 
 
 class CustomTrainingPipeline(object):
@@ -71,15 +99,18 @@ class CustomTrainingPipeline(object):
                  model_name: str = 'resnet10t',
                  visdom_port: int = 9000,
                  batch_size: int = 32,
+                 val_batch_size: int = 4,
                  epochs: int = 200,
                  resume_epoch: int = 1,
                  stop_criteria: float = 1E-7,
                  device: str = 'cuda',
                  image_size: int = 512,
-                 train_workers: int = 0,
+                 train_workers: int = 4,
                  preload_data: bool = False,
+                 mmap_cache_dir: Optional[str] = None,
                  lr_steps: int = 4,
-                 no_load_optim: bool = False):
+                 no_load_optim: bool = False,
+                 checkpoint_optim_every: int = 1):
         """
         Train U-Net denoising model
 
@@ -91,15 +122,18 @@ class CustomTrainingPipeline(object):
             load_path (str, optional): Path to model weights to load. Defaults to None.
             visdom_port (int, optional): Port of visualization. Defaults to 9000.
             batch_size (int, optional): Training batch size. Defaults to 32.
+            val_batch_size (int, optional): Count of validation images inferred together. Defaults to 4.
             epochs (int, optional): Count of epoch. Defaults to 200.
             resume_epoch (int, optional): Epoch number to resume training. Defaults to 1.
             stop_criteria (float, optional): Criteria to stop of training process. Defaults to 1E-7.
             device (str, optional): Target device to train. Defaults to 'cuda'.
             image_size (int, optional): Input image size. Defaults to 512.
-            train_workers (int, optional): Count of parallel dataloaders. Defaults to 0.
+            train_workers (int, optional): Count of parallel dataloaders. Defaults to 4.
             preload_data (bool, optional): Load training and validation data to RAM. Defaults to False.
+            mmap_cache_dir (str, optional): Folder to pack images into memory mapped files, implies data preloading without RAM copies. Defaults to None.
             lr_steps (int, optional): Count of uniformed LR steps. Defaults to 4.
             no_load_optim (bool, optional): Disable load optimizer from checkpoint. Defaults to False.
+            checkpoint_optim_every (int, optional): Save optimizer state into checkpoints every N epochs, 0 to disable. Defaults to 1.
         """
         self.device = device
         self.experiment_folder = experiment_folder
@@ -113,8 +147,13 @@ class CustomTrainingPipeline(object):
         self.resume_epoch = resume_epoch
         self.stop_criteria = stop_criteria
         self.best_test_score = 0
+        self.checkpoint_optim_every = checkpoint_optim_every
+        self._checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+        self._checkpoint_future = None
+        self.log_step = 20
 
         self.image_shape = (image_size, image_size)
+        self._trace_example = torch.rand(1, 3, *self.image_shape, device=device)
 
         os.makedirs(experiment_folder, exist_ok=True)
         os.makedirs(self.checkpoints_dir, exist_ok=True)
@@ -127,7 +166,9 @@ class CustomTrainingPipeline(object):
                 need_crop=True,
                 window_size=self.image_shape[0],
                 optional_dataset_size=400000,
-                preload=preload_data
+                preload=preload_data,
+                mmap_cache_dir=None if mmap_cache_dir is None else os.path.join(mmap_cache_dir, 'train'),
+                fast_transforms=FAST_TRANSFORMS_AVAILABLE
             )
 
         if synth_data_paths is not None:
@@ -135,7 +176,8 @@ class CustomTrainingPipeline(object):
                 clear_images_path=synth_data_paths,
                 window_size=self.image_shape[0],
                 preload=preload_data,
-                optional_dataset_size=100000
+                optional_dataset_size=100000,
+                mmap_cache_dir=None if mmap_cache_dir is None else os.path.join(mmap_cache_dir, 'synthetic')
             )
 
             self.train_base_dataset = torch.utils.data.ConcatDataset(
@@ -147,7 +189,8 @@ class CustomTrainingPipeline(object):
             noisy_images_path=val_data_paths[0],
             clear_images_path=val_data_paths[1],
             preload=preload_data,
-            return_names=True
+            return_names=True,
+            mmap_cache_dir=None if mmap_cache_dir is None else os.path.join(mmap_cache_dir, 'val')
         )
 
         self.train_dataloader = torch.utils.data.DataLoader(
@@ -155,7 +198,22 @@ class CustomTrainingPipeline(object):
             batch_size=batch_size,
             shuffle=True,
             drop_last=True,
-            num_workers=train_workers
+            num_workers=train_workers,
+            pin_memory=True,
+            persistent_workers=train_workers > 0,
+            prefetch_factor=4 if train_workers > 0 else None
+        )
+
+        self.val_dataloader = torch.utils.data.DataLoader(
+            dataset=self.val_dataset,
+            batch_size=val_batch_size,
+            shuffle=False,
+            drop_last=False,
+            collate_fn=list_collate,
+            num_workers=train_workers,
+            pin_memory=True,
+            persistent_workers=train_workers > 0,
+            prefetch_factor=4 if train_workers > 0 else None
         )
 
         self.images_visualizer = None if visdom_port is None else VisImage(
@@ -195,9 +253,18 @@ class CustomTrainingPipeline(object):
 
         self.model = WTSNetTimm(model_name=model_name)
         # self.model.apply(init_weights)
-        self.dwt = DWTHaar()
-        self.iwt = IWTHaar()
+        self.dwt = DWTHaar().to(device)
+        self.iwt = IWTHaar().to(device)
+        self.haar_pyramid = torch.compile(haar_pyramid)
         self.model = self.model.to(device)
+        self.model = self.model.to(memory_format=torch.channels_last)
+        self.amp_device_type = torch.device(device).type
+        self.amp_dtype = torch.bfloat16
+        # bfloat16 has the float32 exponent range, so loss scaling is needed only for float16
+        self.scaler = torch.amp.GradScaler(
+            self.amp_device_type,
+            enabled=self.amp_dtype == torch.float16
+        )
         self.optimizer = torch.optim.SGD(params=self.model.parameters(), lr=0.0001, nesterov=True, momentum=0.9)
         # self.optimizer = torch.optim.RAdam(params=self.model.parameters(), lr=0.001)
         # self.optimizer = AdaSmooth(params=self.model.parameters(), lr=0.001)
@@ -216,11 +283,21 @@ class CustomTrainingPipeline(object):
                 '#' * 5 + ' Model has been loaded by path: {} '.format(load_path) +  '#' * 5
             )
 
-            if not no_load_optim:
+            if not no_load_optim and 'optimizer' in load_data:
                 self.optimizer.load_state_dict(load_data['optimizer'])
                 print(
                     '#' * 5 + ' Optimizer has been loaded by path: {} '.format(load_path) + '#' * 5
                 )
+            elif not no_load_optim:
+                print(
+                    '#' * 5 + ' Optimizer state not found in checkpoint: {}, optimizer starts from scratch '.format(load_path) + '#' * 5
+                )
+
+        torch.backends.cudnn.benchmark = True
+        torch.set_float32_matmul_precision('high')
+        # Compile after weights loading, checkpoints keep keys of the original module
+        # CUDA graphs are disabled, their replays overwrite outputs of previous calls
+        self.model = torch.compile(self.model, mode='max-autotune-no-cudagraphs', fullgraph=False)
 
         # self.optimizer = AdaSmooth(params=self.model.parameters(), lr=0.001)
         
@@ -228,7 +305,11 @@ class CustomTrainingPipeline(object):
         # self.images_criterion_ch2 = MIXLoss(channel=2) # torch.nn.MSELoss()
         # self.images_criterion_ch1 = MIXLoss(channel=1)
         self.images_criterion = MIXLoss(data_range=1)
-        self.perceptual_loss = DISTS()
+        self.perceptual_loss = DISTS().to(device)
+        self.perceptual_loss.eval()
+        for p in self.perceptual_loss.parameters():
+            p.requires_grad_(False)
+        self.perceptual_loss.get_features = torch.compile(self.perceptual_loss.get_features)
         # self.perceptual_loss = None
         # self.final_hist_loss = HistLoss(image_size=128, device=self.device)
         self.final_hist_loss = None
@@ -243,8 +324,22 @@ class CustomTrainingPipeline(object):
 
         # self.adv_loss = Adversarial(image_size=image_size, in_ch=3).to(device)
         self.wavelets_criterion = torch.nn.SmoothL1Loss()
+        # Loss of wavelets level i is scaled by factor^i, scales are built on first use
+        self.wavelets_loss_factor = 1.0
+        self._level_scales = None
         self.accuracy_measure = TorchPSNR().to(device)
 
+        # Same coefficients as cv2.COLOR_YCrCb2RGB, for images in 0..1 range
+        self._ycrcb2rgb = torch.tensor(
+            [
+                [1.0, 1.403, 0.0],
+                [1.0, -0.714, -0.344],
+                [1.0, 0.0, 1.773]
+            ],
+            device=device
+        )
+        self._ycrcb_offset = torch.tensor([0.0, 128.0 / 255.0, 128.0 / 255.0], device=device)
+
         if lr_steps > 0:
             _lr_steps = lr_steps + 1
             lr_milestones = [
@@ -255,8 +350,7 @@ class CustomTrainingPipeline(object):
             self.scheduler = torch.optim.lr_scheduler.MultiStepLR(
                 self.optimizer,
                 milestones=lr_milestones,
-                gamma=0.1,
-                verbose=True
+                gamma=0.1
             )
         else:
             self.scheduler = None
@@ -265,27 +359,30 @@ class CustomTrainingPipeline(object):
         for param_group in self.optimizer.param_groups:
             return param_group['lr']
     
-    def _add_loss(self, loss1, loss2):
-        if loss1 is None:
-            return loss2
-        return loss1 + loss2
-
-    def _compute_wavelets_loss(self, pred_wavelets_pyramid, gt_image, factor: float = 1.0):
-        gt_d0_ll = gt_image
-        _loss = None
-        _loss_scale = 1.0
+    @torch.no_grad()
+    def _gt_pyramid_cache(self, gt_image, levels: int):
+        # Keep targets in full precision when called under autocast
+        with torch.autocast(self.amp_device_type, enabled=False):
+            return self.haar_pyramid(gt_image.float(), levels)
+
+    def _compute_wavelets_loss(self, pred_wavelets_pyramid, gt_pyramid):
+        per_level_losses = []
 
         for i in range(len(pred_wavelets_pyramid)):
-            gt_ll, gt_lh, gt_hl, gt_hh = self.dwt(gt_d0_ll)
-            
-            gt_wavelets = torch.cat((gt_lh, gt_hl, gt_hh), dim=1)
-            _loss = self._add_loss(_loss, self.wavelets_criterion(pred_wavelets_pyramid[i][:, 3:], gt_wavelets)) * _loss_scale
+            _, gt_wavelets = gt_pyramid[i]
+            per_level_losses.append(self.wavelets_criterion(pred_wavelets_pyramid[i][:, 3:], gt_wavelets))
 
-            _loss_scale *= factor
+        if self._level_scales is None or self._level_scales.numel() != len(per_level_losses):
+            self._level_scales = torch.tensor(
+                [self.wavelets_loss_factor ** i for i in range(len(per_level_losses))],
+                device=self.device
+            )
 
-            gt_d0_ll = gt_ll
+        return torch.stack(per_level_losses).mul(self._level_scales).sum()
 
-        return _loss
+    def _ycrcb_to_rgb(self, img: torch.Tensor) -> torch.Tensor:
+        img01 = torch.clip(img, 0, 1) - self._ycrcb_offset.view(3, 1, 1)
+        return torch.einsum('chw,kc->khw', img01, self._ycrcb2rgb).clamp(0, 1)
 
     def _compute_deep_iwt_loss(self, pred_wavelets_pyramid, gt_image):
         composed_image = pred_wavelets_pyramid[-1][:, :3]
@@ -298,82 +395,88 @@ class CustomTrainingPipeline(object):
 
         return _loss
 
-    def _compute_adversarial_loss(self, pred_wavelets_pyramid, gt_image, factor: float = 1.0):
-        gt_d0_ll = gt_image
+    def _compute_adversarial_loss(self, pred_wavelets_pyramid, gt_pyramid, factor: float = 1.0):
         _loss = 0.0
         _loss_scale = 1.0
 
         for i in range(len(pred_wavelets_pyramid)):
-            gt_ll, gt_lh, gt_hl, gt_hh = self.dwt(gt_d0_ll)
+            gt_ll, gt_wavelets = gt_pyramid[i]
             target_loss_function = self.adverserial_losses[i]
 
             # if i == len(pred_wavelets_pyramid) - 1:
             #     gt_wavelets = torch.cat((gt_ll, gt_lh, gt_hl, gt_hh), dim=1)
             #     _loss += target_loss_function(pred_wavelets_pyramid[i], gt_wavelets) * _loss_scale
             # else:
-            gt_wavelets = torch.cat((gt_lh, gt_hl, gt_hh), dim=1)
             _loss += target_loss_function(pred_wavelets_pyramid[i][:, 3:], gt_wavelets) * _loss_scale
 
             _loss_scale *= factor
 
-            gt_d0_ll = gt_ll
-
         return _loss
 
     def _train_step(self, epoch) -> float:
         self.model.train()
-        avg_epoch_loss = 0
+        running_loss = torch.zeros((), device=self.device)
 
         with tqdm.tqdm(total=len(self.train_dataloader)) as pbar:
-            for _noisy_image, _clear_image in self.train_dataloader:
-                noisy_image = _noisy_image.to(self.device)
-                clear_image = _clear_image.to(self.device)
-
-                self.optimizer.zero_grad()
-                output = self.model(noisy_image)
-                pred_image = output[0]
-                pred_wavelets_pyramid = output[1]
-                spatial_attention_maps = output[2]
-
-                # loss = self.images_criterion_ch1(pred_image[:, :1], clear_image[:, :1]) * 0.6 + \
-                #     self.images_criterion_ch2(pred_image[:, 1:], clear_image[:, 1:]) * 0.4
-                loss = self.images_criterion(pred_image, clear_image)
-                # aloss = self.adv_loss(pred_image, clear_image)
-
-                if self.perceptual_loss is not None:
-                    loss = loss / 2 + self.perceptual_loss(pred_image, clear_image) / 2
-                    
-                wloss = self._compute_wavelets_loss(pred_wavelets_pyramid, clear_image)
-                # hist_loss = self.final_hist_loss(pred_image, clear_image)
-                hist_loss = 0
-                # hf_loss = self.hight_freq_loss(pred_image, clear_image)
-
-                total_loss = loss + wloss * 0.2
-
-                total_loss.backward()
+            for batch_i, (_noisy_image, _clear_image) in enumerate(self.train_dataloader):
+                noisy_image = _noisy_image.to(self.device, non_blocking=True, memory_format=torch.channels_last)
+                clear_image = _clear_image.to(self.device, non_blocking=True, memory_format=torch.channels_last)
+
+                self.optimizer.zero_grad(set_to_none=True)
+                with torch.autocast(self.amp_device_type, dtype=self.amp_dtype):
+                    output = self.model(noisy_image)
+
+                # SSIM and DISTS statistics lose precision in bfloat16, so losses are computed in float32
+                with torch.autocast(self.amp_device_type, enabled=False):
+                    pred_image = output[0].float()
+                    pred_wavelets_pyramid = [w.float() for w in output[1]]
+                    spatial_attention_maps = output[2]
+
+                    # loss = self.images_criterion_ch1(pred_image[:, :1], clear_image[:, :1]) * 0.6 + \
+                    #     self.images_criterion_ch2(pred_image[:, 1:], clear_image[:, 1:]) * 0.4
+                    loss = self.images_criterion(pred_image, clear_image)
+                    # aloss = self.adv_loss(pred_image, clear_image)
+
+                    if self.perceptual_loss is not None:
+                        loss = loss / 2 + self.perceptual_loss(pred_image, clear_image) / 2
+                        
+                    gt_pyramid = self._gt_pyramid_cache(clear_image, len(pred_wavelets_pyramid))
+                    wloss = self._compute_wavelets_loss(pred_wavelets_pyramid, gt_pyramid)
+                    # hist_loss = self.final_hist_loss(pred_image, clear_image)
+                    hist_loss = 0
+                    # hf_loss = self.hight_freq_loss(pred_image, clear_image)
+
+                    total_loss = loss + wloss * 0.2
+
+                self.scaler.scale(total_loss).backward()
+                self.scaler.unscale_(self.optimizer)
                 torch.nn.utils.clip_grad_norm_(self.model.parameters(), 2.0)
-                self.optimizer.step()
-
-                pbar.postfix = \
-                    'Epoch: {}/{}, px_loss: {:.7f}, w_loss: {:.7f}'.format(
-                        epoch,
-                        self.epochs,
-                        loss.item(),
-                        wloss.item()
-                    )
-                avg_epoch_loss += loss.item() / len(self.train_dataloader)
-
-                if self.images_visualizer is not None:
-                    wavelets_pred = pred_wavelets_pyramid[0].detach()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+
+                running_loss += loss.detach().float()
+
+                # Reading losses values synchronizes with device, so do it only once per log_step batches
+                if batch_i % self.log_step == 0:
+                    pbar.postfix = \
+                        'Epoch: {}/{}, px_loss: {:.7f}, w_loss: {:.7f}'.format(
+                            epoch,
+                            self.epochs,
+                            loss.item(),
+                            wloss.item()
+                        )
+
+                if self.images_visualizer is not None and self.images_visualizer.should_emit():
+                    wavelets_pred = pred_wavelets_pyramid[0].detach().float()
                     with torch.no_grad():
-                        wavelets_gt = self.dwt(clear_image)
+                        wavelets_gt = [gt_pyramid[0][0], *torch.split(gt_pyramid[0][1], 3, dim=1)]
                         wavelets_inp = self.dwt(noisy_image)
 
                         vis_idx = self.images_visualizer.per_batch(
                             {
                                 'input_img': noisy_image,
                                 'input_wavelets': wavelets_inp,
-                                'pred_image': pred_image.detach(),
+                                'pred_image': pred_image.detach().float(),
                                 'pred_wavelets': wavelets_pred.detach(),
                                 'gt_wavelets': wavelets_gt,
                                 'gt_image': clear_image
@@ -382,13 +485,18 @@ class CustomTrainingPipeline(object):
 
                         self.attention_visualizer.per_batch(
                             {
-                                'sa_list': spatial_attention_maps
+                                'sa_list': [sa.detach().float() for sa in spatial_attention_maps]
                             },
                             i=vis_idx
                         )
+                elif self.images_visualizer is not None:
+                    self.images_visualizer.skip_batch()
+                    self.attention_visualizer.skip_batch()
 
                 pbar.update(1)
 
+        avg_epoch_loss = (running_loss / len(self.train_dataloader)).item()
+
         return avg_epoch_loss
 
     def _validation_step(self) -> Tuple[float, float]:
@@ -398,42 +506,46 @@ class CustomTrainingPipeline(object):
         test_len = 0
 
         if self.val_dataset is not None:
-            for sample_i in tqdm.tqdm(range(len(self.val_dataset))):
-                _noisy_image, _clear_image, image_name = self.val_dataset[sample_i]
-
-                noisy_image = _noisy_image.to(self.device)
-                clear_image = _clear_image.to(self.device)
+            for _noisy_images, _clear_images, image_names in tqdm.tqdm(self.val_dataloader):
+                noisy_images = [img.to(self.device, non_blocking=True) for img in _noisy_images]
+                clear_images = [img.to(self.device, non_blocking=True) for img in _clear_images]
 
                 with torch.no_grad():
-                    restored_image = denoise_inference(
-                        tensor_img=noisy_image, model=self.model, window_size=self.image_shape[0], 
-                        batch_size=self.batch_size, crop_size=self.image_shape[0] // 32
-                    ).unsqueeze(0)
+                    with torch.autocast(self.amp_device_type, dtype=self.amp_dtype):
+                        restored_images = denoise_inference_batch(
+                            tensor_imgs=noisy_images, model=self.model, window_size=self.image_shape[0],
+                            batch_size=self.batch_size, crop_size=self.image_shape[0] // 32,
+                            memory_format=torch.channels_last
+                        )
 
-                    # loss = self.images_criterion_ch1(restored_image[:, :1], clear_image[:1].unsqueeze(0)) * 0.6 + \
-                    #     self.images_criterion_ch2(restored_image[:, 1:], clear_image[1:].unsqueeze(0)) * 0.4
-                    loss = self.images_criterion(restored_image, clear_image.unsqueeze(0))
+                    for _restored_image, clear_image, image_name in zip(restored_images, clear_images, image_names):
+                        with torch.autocast(self.amp_device_type, enabled=False):
+                            restored_image = _restored_image.unsqueeze(0).float()
 
-                    if self.perceptual_loss is not None:
-                        loss = loss / 2 + self.perceptual_loss(restored_image, clear_image.unsqueeze(0)) / 2
-                    
-                    avg_loss_rate += loss.item()
+                            # loss = self.images_criterion_ch1(restored_image[:, :1], clear_image[:1].unsqueeze(0)) * 0.6 + \
+                            #     self.images_criterion_ch2(restored_image[:, 1:], clear_image[1:].unsqueeze(0)) * 0.4
+                            loss = self.images_criterion(restored_image, clear_image.unsqueeze(0))
+
+                            if self.perceptual_loss is not None:
+                                loss = loss / 2 + self.perceptual_loss(restored_image, clear_image.unsqueeze(0)) / 2
+                        
+                        avg_loss_rate += loss.item()
 
-                    val_psnr = self.accuracy_measure(
-                        restored_image,
-                        clear_image.unsqueeze(0)
-                    )
+                        val_psnr = self.accuracy_measure(
+                            restored_image,
+                            clear_image.unsqueeze(0)
+                        )
 
-                    acc_rate = val_psnr.item()
+                        acc_rate = val_psnr.item()
 
-                    avg_acc_rate += acc_rate
-                    test_len += 1
+                        avg_acc_rate += acc_rate
+                        test_len += 1
 
-                    # result_path = os.path.join(self.output_val_images_dir, '{}.png'.format(sample_i + 1))
-                    result_path = os.path.join(self.output_val_images_dir, image_name)
-                    val_img = (torch.clip(restored_image[0].to('cpu').permute(1, 2, 0), 0, 1) * 255.0).numpy().astype(np.uint8)
-                    val_img = cv2.cvtColor(val_img, cv2.COLOR_YCrCb2RGB)
-                    Image.fromarray(val_img).save(result_path)
+                        # result_path = os.path.join(self.output_val_images_dir, '{}.png'.format(sample_i + 1))
+                        result_path = os.path.join(self.output_val_images_dir, image_name)
+                        val_img = self._ycrcb_to_rgb(restored_image[0])
+                        val_img = (val_img.permute(1, 2, 0) * 255.0).round().to(torch.uint8).cpu().numpy()
+                        Image.fromarray(val_img).save(result_path)
 
         if test_len > 0:
             avg_acc_rate /= test_len
@@ -441,6 +553,7 @@ class CustomTrainingPipeline(object):
 
         if self.scheduler is not None:
             self.scheduler.step()
+            print('Learning rate: {}'.format(self.get_lr()))
 
         return avg_loss_rate, avg_acc_rate
 
@@ -455,8 +568,11 @@ class CustomTrainingPipeline(object):
                 }
             )
 
+    def _get_base_model(self) -> torch.nn.Module:
+        return getattr(self.model, '_orig_mod', self.model)
+
     def _save_best_traced_model(self, save_path: str):
-        traced_model = torch.jit.trace(self.model, torch.rand(1, 3, *self.image_shape))
+        traced_model = torch.jit.trace(self._get_base_model(), self._trace_example)
         torch.jit.save(traced_model, save_path)
 
     def _save_best_checkpoint(self, epoch, avg_acc_rate):
@@ -471,24 +587,35 @@ class CustomTrainingPipeline(object):
 
         self.model.eval()
         save_state = {
-            'model': self.model.state_dict(),
-            'optimizer': self.optimizer.state_dict(),
+            'model': state_to_cpu(self._get_base_model().state_dict()),
             'acc': avg_acc_rate,
             'epoch': epoch
         }
 
-        torch.save(
-            save_state,
-            latest_model_path
-        )
+        if self.checkpoint_optim_every > 0 and epoch % self.checkpoint_optim_every == 0:
+            save_state['optimizer'] = state_to_cpu(self.optimizer.state_dict())
+
+        save_paths = [latest_model_path]
 
         if self.best_test_score - avg_acc_rate < -1E-5:
             self.best_test_score = avg_acc_rate
+            save_paths.append(best_model_path)
 
-            torch.save(
-                save_state,
-                best_model_path
-            )
+        # Write files in background, only one saving is in progress at a time
+        self._wait_checkpoint_saving()
+        self._checkpoint_future = self._checkpoint_executor.submit(
+            self._write_checkpoint, save_state, save_paths
+        )
+
+    @staticmethod
+    def _write_checkpoint(save_state, save_paths):
+        for save_path in save_paths:
+            torch.save(save_state, save_path)
+
+    def _wait_checkpoint_saving(self):
+        if self._checkpoint_future is not None:
+            self._checkpoint_future.result()
+            self._checkpoint_future = None
 
     def _check_stop_criteria(self):
         return self.get_lr() - self.stop_criteria < -1E-9
@@ -503,6 +630,8 @@ class CustomTrainingPipeline(object):
             if self.scheduler is not None and self._check_stop_criteria():
                 break
 
+        self._wait_checkpoint_saving()
+
 
 def parse_args() -> Namespace:
     parser = ArgumentParser(description='Training pipeline')
@@ -547,6 +676,10 @@ def parse_args() -> Namespace:
         '--batch_size', type=int, required=False, default=32,
         help='Training batch size.'
     )
+    parser.add_argument(
+        '--val_batch_size', type=int, required=False, default=4,
+        help='Count of validation images inferred together.'
+    )
     parser.add_argument(
         '--lr_milestones', type=int, required=False, default=3,
         help='Count or learning rate scheduler milestones.'
@@ -555,10 +688,18 @@ def parse_args() -> Namespace:
         '--preload_datasets', action='store_true',
         help='Load images from datasaets into memory.'
     )
+    parser.add_argument(
+        '--mmap_cache_dir', type=str, required=False,
+        help='Path to folder to pack datasets into memory mapped files, shared by dataset workers (implies --preload_datasets).'
+    )
     parser.add_argument(
         '--no_load_optim', action='store_true',
         help='Disable optimizer parameters loading from checkpoint.'
     )
+    parser.add_argument(
+        '--checkpoint_optim_every', type=int, required=False, default=1,
+        help='Save optimizer state into checkpoints every N epochs, 0 to disable.'
+    )
     parser.add_argument(
         '--synthetic_data_paths', type=str, required=False,
         help='Path to folder with clear images to generate synthetic noisy dataset.'
@@ -589,11 +730,14 @@ if __name__ == '__main__':
         epochs=args.epochs,
         resume_epoch=args.resume_epoch,
         batch_size=args.batch_size,
+        val_batch_size=args.val_batch_size,
         image_size=args.image_size,
         train_workers=args.njobs,
         preload_data=args.preload_datasets,
+        mmap_cache_dir=args.mmap_cache_dir,
         lr_steps=args.lr_milestones,
-        no_load_optim=args.no_load_optim
+        no_load_optim=args.no_load_optim,
+        checkpoint_optim_every=args.checkpoint_optim_every
     ).fit()
 
     exit(0)
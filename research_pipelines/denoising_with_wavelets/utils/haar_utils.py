@@ -13,6 +13,7 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+from typing import List, Tuple
 import torch
 import torch.nn as nn
 
@@ -41,6 +42,42 @@ class HaarForward(nn.Module):
         return torch.cat([ll,lh,hl,hh], axis=1)
 
 
+def haar_pyramid(x: torch.Tensor, levels: int) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """
+    Performs a multilevel 2d DWT decomposition of an image using Haar Wavelets.
+    Levels are computed with slicing and elementwise ops only, so under
+    torch.compile each level becomes one fused elementwise kernel instead of
+    the separate slice/cat launches of the eager DWT
+
+    Arguments:
+        x (torch.Tensor): input tensor of shape [b, c, h, w]
+        levels (int): count of decomposition levels
+
+    Returns:
+        out (list): list of (ll, details) tuples per level, where ll is of shape
+            [b, c, h / 2^(i + 1), w / 2^(i + 1)] and details are LH, HL, HH bands
+            stored contiguously as [b, c * 3, h / 2^(i + 1), w / 2^(i + 1)],
+            same layout as HaarForward output without LL
+    """
+    pyramid = []
+    ll = x
+
+    for _ in range(levels):
+        x00 = ll[:, :, 0::2, 0::2]
+        x01 = ll[:, :, 0::2, 1::2]
+        x10 = ll[:, :, 1::2, 0::2]
+        x11 = ll[:, :, 1::2, 1::2]
+
+        lh = HaarForward.alpha * (x00 + x01 - x10 - x11)
+        hl = HaarForward.alpha * (x00 - x01 + x10 - x11)
+        hh = HaarForward.alpha * (x00 - x01 - x10 + x11)
+        ll = HaarForward.alpha * (x00 + x01 + x10 + x11)
+
+        pyramid.append((ll, torch.cat((lh, hl, hh), dim=1)))
+
+    return pyramid
+
+
 class HaarInverse(nn.Module):
     """
     Performs a 2d DWT Inverse reconstruction of an image using Haar Wavelets
@@ -6,6 +6,13 @@ import numpy as np
 import random
 import pywt
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+FAST_TRANSFORMS_AVAILABLE = numba is not None
+
 
 class Rotate(Enum):
     """Rotate enumerates class"""
@@ -125,6 +132,73 @@ def random_crop_with_transforms(
     )
 
 
+def _crop_rotate_ycrcb_kernel(src: np.ndarray, y: int, x: int, rotation: int, out: np.ndarray):
+    """
+    Crop RGB uint8 window from src, rotate it by rotation * 90 degrees clockwise
+    and write it into out as CHW float32 YCrCb image in 0..1 range
+    """
+    window_size = out.shape[1]
+    last = window_size - 1
+    for i in range(window_size):
+        for j in range(window_size):
+            if rotation == 0:
+                si, sj = i, j
+            elif rotation == 1:
+                si, sj = last - j, i
+            elif rotation == 2:
+                si, sj = last - i, last - j
+            else:
+                si, sj = j, last - i
+
+            r = np.float32(src[y + si, x + sj, 0])
+            g = np.float32(src[y + si, x + sj, 1])
+            b = np.float32(src[y + si, x + sj, 2])
+
+            # Same coefficients as cv2.COLOR_RGB2YCrCb for uint8 images
+            luma = r * np.float32(0.299) + g * np.float32(0.587) + b * np.float32(0.114)
+            cr = (r - luma) * np.float32(0.713) + np.float32(128.0)
+            cb = (b - luma) * np.float32(0.564) + np.float32(128.0)
+
+            out[0, i, j] = min(max(np.floor(luma + np.float32(0.5)), 0), 255) / np.float32(255.0)
+            out[1, i, j] = min(max(np.floor(cr + np.float32(0.5)), 0), 255) / np.float32(255.0)
+            out[2, i, j] = min(max(np.floor(cb + np.float32(0.5)), 0), 255) / np.float32(255.0)
+
+
+if numba is not None:
+    # Dataloader workers are separate processes already, so kernel runs single threaded
+    _crop_rotate_ycrcb_kernel = numba.njit(cache=True, fastmath=True)(_crop_rotate_ycrcb_kernel)
+
+
+def random_crop_to_ycrcb(
+        image1: np.ndarray,
+        image2: np.ndarray,
+        window_size: int = 224) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fused equivalent of random_crop_with_transforms without random swap,
+    RGB to YCrCb conversion and preprocess_image(img, 0, 1), compiled with numba
+
+    Args:
+        image1: first image in HWC RGB uint8 format
+        image2: second image in HWC RGB uint8 format, same size as first
+        window_size: crop size
+
+    Returns:
+        Pair of same crops of images in CHW float32 YCrCb format in 0..1 range
+    """
+    assert numba is not None, 'Fast transforms require numba package'
+
+    x = np.random.randint(0, image1.shape[1] - window_size + 1)
+    y = np.random.randint(0, image1.shape[0] - window_size + 1)
+    rotation = np.random.randint(0, 4)
+
+    crop1 = np.empty((3, window_size, window_size), dtype=np.float32)
+    crop2 = np.empty((3, window_size, window_size), dtype=np.float32)
+    _crop_rotate_ycrcb_kernel(image1, y, x, rotation, crop1)
+    _crop_rotate_ycrcb_kernel(image2, y, x, rotation, crop2)
+
+    return crop1, crop2
+
+
 def upper_bin(img, threshold):
     res = img.copy()
     res[img > threshold] = 255
@@ -1,3 +1,4 @@
+from typing import List
 import numpy as np
 import torch
 from tqdm import tqdm
@@ -106,6 +107,93 @@ def denoise_inference(
 
 
 
+def denoise_inference_batch(
+        tensor_imgs: List[torch.Tensor],
+        model: torch.nn.Module,
+        window_size: int = 224,
+        batch_size: int = 32,
+        crop_size: int = 0,
+        memory_format: torch.memory_format = torch.contiguous_format) -> List[torch.Tensor]:
+    """
+    Sliding window inference for several images at once: windows of all
+    images are packed into common batches of batch_size to fill the device
+
+    Args:
+        tensor_imgs: list of CHW image tensors, sizes could differ
+        model: denoising model, first output is the restored image
+        window_size: model input window size
+        batch_size: count of windows per model call
+        crop_size: border of each predicted window to be dropped
+        memory_format: memory format of windows passed to model
+
+    Returns:
+        List of restored CHW images with same sizes as input images
+    """
+    crop_d = crop_size
+    output_size = window_size - crop_d * 2
+
+    crops = []
+    grid_sizes = []
+    for tensor_img in tensor_imgs:
+        margin_width = (
+            output_size - tensor_img.size(2) % output_size
+        ) * (tensor_img.size(2) % output_size != 0)
+
+        margin_height = (
+            output_size - tensor_img.size(1) % output_size
+        ) * (tensor_img.size(1) % output_size != 0)
+
+        padded_tensor = torch.nn.functional.pad(
+            tensor_img.unsqueeze(0),
+            [crop_d, crop_d + margin_width, crop_d, crop_d + margin_height],
+            mode='reflect'
+        ).squeeze(0)
+
+        n_rows = padded_tensor.size(1) // output_size
+        n_cols = padded_tensor.size(2) // output_size
+        grid_sizes.append((n_rows, n_cols))
+
+        # [C * window_size^2, n_rows * n_cols] -> [n_rows * n_cols, C, window_size, window_size]
+        patches = torch.nn.functional.unfold(
+            padded_tensor.unsqueeze(0),
+            kernel_size=window_size,
+            stride=output_size
+        )[0]
+        crops.append(patches.t().reshape(-1, padded_tensor.size(0), window_size, window_size))
+
+    crops = torch.cat(crops).contiguous(memory_format=memory_format)
+
+    # Copy each chunk before the next model call: compiled models could reuse output buffers
+    outs = None
+    for start in range(0, crops.size(0), batch_size):
+        pred = model(crops[start:start + batch_size])[0][
+            :, :, crop_d:crop_d + output_size, crop_d:crop_d + output_size
+        ]
+        if outs is None:
+            outs = pred.new_empty((crops.size(0), *pred.shape[1:]))
+        outs[start:start + pred.size(0)].copy_(pred)
+
+    result_images = []
+    for tensor_img, (n_rows, n_cols), img_outs in zip(
+            tensor_imgs, grid_sizes, torch.split(outs, [r * c for r, c in grid_sizes])):
+        # Predicted windows do not overlap after crop, so folding places them back without blending
+        result_image = torch.nn.functional.fold(
+            img_outs.reshape(img_outs.size(0), -1).t().unsqueeze(0),
+            output_size=(n_rows * output_size, n_cols * output_size),
+            kernel_size=output_size,
+            stride=output_size
+        )[0]
+        result_images.append(
+            result_image[
+                :,
+                :tensor_img.size(1),
+                :tensor_img.size(2)
+            ]
+        )
+
+    return result_images
+
+
 def eval_denoise_inference(
         tensor_img: torch.Tensor,
         model: torch.nn.Module,